@@ -1,29 +1,627 @@
-import json
+import argparse
+import asyncio
+import atexit
+import copy
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+import functools
+import hashlib
 import os
+import pickle
 from pathlib import Path
 import random
+import re
+import shelve
+import sys
+import time
 from google import genai
+from google.genai import types as genai_types
+import httpx
+import numpy as np
+import orjson
 
 
+# Environment is read once at import
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
+MOCK_MODE = os.environ.get("MOCK_GEMINI") == "1"
+# Judge exact canonical moves locally instead of calling Gemini (opt-in)
+FAST_PATH_CANONICAL = os.environ.get("FAST_PATH_CANONICAL") == "1"
+# Reuse decisions for near-duplicate free-text inputs (opt-in, one embedding call per miss)
+SEMANTIC_CACHE = os.environ.get("SEMANTIC_CACHE") == "1"
 
+PROMPT_PATH = Path(__file__).resolve().parent.parent / "prompts" / "judge_prompt.txt"
+MODEL_NAME = "gemini-1.5-flash"
+PROMPT_CACHE_TTL_SECONDS = 3600
+PROMPT_CACHE_TTL = f"{PROMPT_CACHE_TTL_SECONDS}s"
+PROMPT_CACHE_REFRESH_SECONDS = 300  # Extend the TTL when this close to expiry
+PROMPT_CACHE_MIN_TOKENS = 4096  # Smallest prompt Gemini accepts for explicit caching
+CHARS_PER_TOKEN = 4  # Rough estimate for English text
+HTTP_TIMEOUT_MS = 30_000
+HTTP_KEEPALIVE_CONNECTIONS = 16
+MAX_CONCURRENT_ROUNDS = 10
+BATCH_POLL_SECONDS = 10
+BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED",
+}
+ROUNDS_PER_MATCH = 3
+AI_MOVES = ("rock", "paper", "scissors", "bomb")  # Exactly 4 so 2 random bits pick one
+CANONICAL_MOVES = frozenset(AI_MOVES)
+RESPONSE_CACHE_SIZE = 4096
+RESPONSE_CACHE_PATH = Path.home() / ".rps_judge_cache" / "responses"
+EMBEDDING_MODEL = "text-embedding-004"
+SEMANTIC_CACHE_PATH = Path.home() / ".rps_judge_cache" / "semantic.pkl"
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_SIZE = 10_000
+
+# Exact-match cache of Gemini decisions: in-memory LRU backed by a shelve file
+_response_cache = OrderedDict()
+_response_shelf = None
+_semantic_cache = None
+
+# Leading ```json / ``` and trailing ``` fences around a model response
+_FENCE_RE = re.compile(r"^\s*```(?:json)?|```\s*$")
+
+# Mock judge intent heuristics (simple keyword matching), compiled once
+MOCK_MOVE_KEYWORDS = {
+    "rock": ["rock", "rok", "stone", "boulder", "fist"],
+    "paper": ["paper", "ppr", "pap", "sheet", "document"],
+    "scissors": ["scissors", "scissor", "sciz", "snip", "shears"],
+    "bomb": ["bomb", "boom", "nuke", "dynamite", "c4", "explosion"]
+}
+MOCK_REFUSALS = ["pass", "skip", "i don't want", "dont want", "not play", "nope"]
+
+_MOVE_RE = re.compile(
+    "|".join(
+        f"(?P<{mv}>" + "|".join(map(re.escape, keys)) + ")"
+        for mv, keys in MOCK_MOVE_KEYWORDS.items()
+    ),
+    re.IGNORECASE,
+)
+_REFUSE_RE = re.compile("|".join(map(re.escape, MOCK_REFUSALS)), re.IGNORECASE)
+
+# Whole-word keyword lookup for the common case (input is just a move word)
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_MOVE_TOKENS = {k: mv for mv, keys in MOCK_MOVE_KEYWORDS.items() for k in keys}
+
+
+def _build_outcome_table():
+    """Precompute (round_winner, round_explanation) for every (p1, p2) pair."""
+    beats = {"rock": "scissors", "scissors": "paper", "paper": "rock"}
+    table = {}
+    for p1 in (*MOCK_MOVE_KEYWORDS, None):
+        for p2 in MOCK_MOVE_KEYWORDS:
+            if p1 == p2:
+                outcome = ("draw", f"Both players played {p1}. It's a draw.")
+            elif p1 == "bomb":
+                outcome = ("player1", "Player1's bomb beats player2's move.")
+            elif p2 == "bomb":
+                outcome = ("player2", "Player2's bomb beats player1's move.")
+            elif beats.get(p1) == p2:
+                outcome = ("player1", f"{p1} beats {p2}.")
+            elif beats.get(p2) == p1:
+                outcome = ("player2", f"{p2} beats {p1}.")
+            else:
+                outcome = ("draw", "No clear winner (unexpected input).")
+            table[(p1, p2)] = outcome
+    return table
+
+
+_OUTCOME = _build_outcome_table()
+
+
+@functools.lru_cache(maxsize=1)
 def load_system_prompt():
-    """Load the system prompt from file."""
-    prompt_path = Path(__file__).parent.parent / "prompts" / "judge_prompt.txt"
-    with open(prompt_path, "r") as f:
-        return f.read()
+    """Load the system prompt from file (read once per process, then cached)."""
+    return PROMPT_PATH.read_text()
+
+
+def create_client(api_key):
+    """
+    Create the Gemini client on a persistent HTTP/2 connection pool.
+
+    The client is created once per session and reused for every round and
+    match, so all calls share kept-alive connections instead of paying a
+    TCP/TLS handshake each round.
+    """
+    pool_args = {
+        "http2": True,
+        "limits": httpx.Limits(max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS),
+    }
+    return genai.Client(
+        api_key=api_key,
+        http_options=genai_types.HttpOptions(
+            timeout=HTTP_TIMEOUT_MS,
+            client_args=pool_args,
+            async_client_args=pool_args,
+        ),
+    )
+
+
+def create_prompt_cache(client, system_prompt):
+    """
+    Upload the judge instructions as Gemini cached content.
+
+    The cached prefix is reused by every round, so only the per-round game
+    context has to be sent and prefilled. Returns a {"name", "expires_at"}
+    dict; name is None when caching is unavailable, in which case rounds
+    send the instructions as system_instruction instead.
+    """
+    prompt_cache = {"name": None, "expires_at": 0.0}
+    # Explicit caching rejects prompts below the model's minimum size, so
+    # don't make a request that can only fail
+    if len(system_prompt) // CHARS_PER_TOKEN < PROMPT_CACHE_MIN_TOKENS:
+        return prompt_cache
+    _upload_prompt_cache(client, system_prompt, prompt_cache)
+    return prompt_cache
+
+
+def _upload_prompt_cache(client, system_prompt, prompt_cache):
+    """(Re)create the cached content and record its name and expiry."""
+    try:
+        cache = client.caches.create(
+            model=MODEL_NAME,
+            config={"system_instruction": system_prompt, "ttl": PROMPT_CACHE_TTL},
+        )
+    except Exception as e:
+        print("Prompt caching unavailable, sending instructions each round:", e)
+        prompt_cache["name"] = None
+    else:
+        prompt_cache["name"] = cache.name
+        prompt_cache["expires_at"] = time.monotonic() + PROMPT_CACHE_TTL_SECONDS
+
+
+def prompt_cache_name(client, system_prompt, prompt_cache):
+    """
+    Name of a live prompt cache for the next round, or None.
+
+    Extends the TTL shortly before it runs out; if that fails (e.g. the cache
+    already expired or was deleted) the cache is recreated.
+    """
+    if prompt_cache is None or prompt_cache["name"] is None:
+        return None
+    if time.monotonic() >= prompt_cache["expires_at"] - PROMPT_CACHE_REFRESH_SECONDS:
+        try:
+            client.caches.update(name=prompt_cache["name"], config={"ttl": PROMPT_CACHE_TTL})
+        except Exception:
+            _upload_prompt_cache(client, system_prompt, prompt_cache)
+        else:
+            prompt_cache["expires_at"] = time.monotonic() + PROMPT_CACHE_TTL_SECONDS
+    return prompt_cache["name"]
+
+
+def delete_prompt_cache(client, prompt_cache):
+    """Delete the cached content (called at exit so it doesn't linger until its TTL)."""
+    if prompt_cache is None or prompt_cache["name"] is None:
+        return
+    try:
+        client.caches.delete(name=prompt_cache["name"])
+    except Exception:
+        pass
+    prompt_cache["name"] = None
+
+
+@functools.lru_cache(maxsize=4)
+def _prompt_digest(system_prompt):
+    """Digest of the judge instructions (hashed once per distinct prompt)."""
+    return hashlib.sha256(system_prompt.encode()).digest()
+
+
+def response_cache_key(system_prompt, game_context):
+    """
+    Key a judge call by model, generation config, prompt and full game context.
+
+    Bomb flags and round number are part of the context, so any state that
+    changes the expected decision also changes the key. Model and config are
+    included so persisted decisions are not reused after either changes; the
+    prompt itself is covered by its digest, and the cache name is irrelevant.
+    """
+    config = {
+        k: v for k, v in judge_config(system_prompt).items()
+        if k not in ("cached_content", "system_instruction")
+    }
+    h = hashlib.blake2b(orjson.dumps(game_context, option=orjson.OPT_SORT_KEYS))
+    h.update(MODEL_NAME.encode())
+    h.update(orjson.dumps(config, option=orjson.OPT_SORT_KEYS))
+    h.update(_prompt_digest(system_prompt))
+    return h.hexdigest()
+
+
+def _open_response_shelf():
+    """Open the on-disk response cache once; None if it can't be used."""
+    global _response_shelf
+    if _response_shelf is None:
+        try:
+            RESPONSE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            _response_shelf = shelve.open(str(RESPONSE_CACHE_PATH))
+        except Exception as e:
+            print("Response cache disk store unavailable, using memory only:", e)
+            _response_shelf = False
+        else:
+            atexit.register(_response_shelf.close)
+    return _response_shelf if _response_shelf is not False else None
+
+
+def get_cached_decision(key):
+    """Return a copy of a previously seen judge decision for this key, or None."""
+    if key in _response_cache:
+        _response_cache.move_to_end(key)
+        return copy.deepcopy(_response_cache[key])
+    shelf = _open_response_shelf()
+    if shelf is not None and key in shelf:
+        decision = shelf[key]
+        store_cached_decision(key, decision, persist=False)
+        return copy.deepcopy(decision)
+    return None
+
+
+def store_cached_decision(key, judge_decision, persist=True):
+    """Remember a copy of a judge decision in memory (LRU) and optionally on disk."""
+    judge_decision = copy.deepcopy(judge_decision)
+    _response_cache[key] = judge_decision
+    _response_cache.move_to_end(key)
+    if len(_response_cache) > RESPONSE_CACHE_SIZE:
+        _response_cache.popitem(last=False)
+    if persist:
+        shelf = _open_response_shelf()
+        if shelf is not None:
+            shelf[key] = judge_decision
+
+
+class SemanticCache:
+    """
+    Similarity cache of judge decisions keyed by player input embeddings.
+
+    A hit needs cosine similarity >= threshold with a stored input AND the
+    exact same rest of the game context (prompt, round number, player 1 move,
+    bomb flags), so a decision is never reused across different game states.
+    Holds at most max_entries, evicting the least recently used. Embeddings
+    of a different dimension than the stored ones never match; adding one
+    clears the cache, since the two can't be compared.
+    """
+
+    PERSISTED_FIELDS = (
+        "model", "embeddings", "context_keys", "decisions", "last_used", "rows_by_context", "clock",
+    )
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_SIZE,
+                 model=EMBEDDING_MODEL):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.model = model  # Embedding model the stored vectors came from
+        self.clear()
+
+    def clear(self):
+        """Drop all entries."""
+        self.embeddings = None  # Unit-normalized rows, float32
+        self.context_keys = []
+        self.decisions = []
+        self.last_used = []
+        self.rows_by_context = {}
+        self.clock = 0
+
+    def lookup(self, embedding, context_key):
+        """Return a cached decision for a similar input in the same context, or None."""
+        rows = self.rows_by_context.get(context_key)
+        vector = _unit(embedding)
+        if not rows or vector.shape != self.embeddings.shape[1:]:
+            return None
+        sims = self.embeddings[rows] @ vector
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold:
+            return None
+        row = rows[best]
+        self.clock += 1
+        self.last_used[row] = self.clock
+        return self.decisions[row]
+
+    def add(self, embedding, context_key, judge_decision):
+        """Store a decision, evicting the least recently used entry when full."""
+        vector = _unit(embedding)
+        if self.embeddings is not None and vector.shape != self.embeddings.shape[1:]:
+            self.clear()
+        self.clock += 1
+        if self.embeddings is None:
+            self.embeddings = np.empty((64, len(vector)), np.float32)
+
+        if len(self.decisions) < self.max_entries:
+            row = len(self.decisions)
+            if row == len(self.embeddings):
+                grown = np.empty((2 * row, self.embeddings.shape[1]), np.float32)
+                grown[:row] = self.embeddings
+                self.embeddings = grown
+            self.context_keys.append(context_key)
+            self.decisions.append(judge_decision)
+            self.last_used.append(self.clock)
+        else:
+            row = int(np.argmin(self.last_used))
+            self.rows_by_context[self.context_keys[row]].remove(row)
+            self.context_keys[row] = context_key
+            self.decisions[row] = judge_decision
+            self.last_used[row] = self.clock
+
+        self.embeddings[row] = vector
+        self.rows_by_context.setdefault(context_key, []).append(row)
+
+    def state(self):
+        """Entries to persist; threshold and size limit always come from config."""
+        return {name: getattr(self, name) for name in self.PERSISTED_FIELDS}
+
+    def restore(self, state):
+        """Load persisted entries, keeping only the most recently used if over max_entries."""
+        for name in self.PERSISTED_FIELDS:
+            setattr(self, name, state[name])
+        if len(self.decisions) > self.max_entries:
+            keep = sorted(np.argsort(self.last_used)[len(self.decisions) - self.max_entries:])
+            self.embeddings = self.embeddings[keep]
+            self.context_keys = [self.context_keys[i] for i in keep]
+            self.decisions = [self.decisions[i] for i in keep]
+            self.last_used = [self.last_used[i] for i in keep]
+            self.rows_by_context = {}
+            for row, context_key in enumerate(self.context_keys):
+                self.rows_by_context.setdefault(context_key, []).append(row)
+
+
+def _unit(embedding):
+    """Normalize an embedding so a dot product is cosine similarity."""
+    vector = np.asarray(embedding, np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+def _get_semantic_cache():
+    """Load the semantic cache from disk once (or start empty) and save it at exit."""
+    global _semantic_cache
+    if _semantic_cache is None:
+        _semantic_cache = SemanticCache()
+        try:
+            with open(SEMANTIC_CACHE_PATH, "rb") as f:
+                state = pickle.load(f)
+        except Exception:
+            state = None
+        # Vectors from another embedding model aren't comparable; start over
+        if isinstance(state, dict) and state.get("model") == EMBEDDING_MODEL:
+            try:
+                _semantic_cache.restore(state)
+            except Exception:
+                _semantic_cache.clear()
+        atexit.register(_save_semantic_cache)
+    return _semantic_cache
+
+
+def _save_semantic_cache():
+    """Write the semantic cache's contents to disk."""
+    try:
+        SEMANTIC_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(SEMANTIC_CACHE_PATH, "wb") as f:
+            pickle.dump(_semantic_cache.state(), f)
+    except Exception as e:
+        print("Could not save semantic cache:", e)
+
+
+def semantic_context_key(system_prompt, game_context):
+    """Key for everything in the round except the player's free-text input."""
+    return response_cache_key(system_prompt, {**game_context, "player2_move": None})
+
+
+def get_similar_decision(system_prompt, game_context, embedding):
+    """Return a copy of a decision for a near-duplicate input, or None."""
+    if embedding is None:
+        return None
+    judge_decision = _get_semantic_cache().lookup(
+        embedding, semantic_context_key(system_prompt, game_context)
+    )
+    if judge_decision is None:
+        return None
+    judge_decision = copy.deepcopy(judge_decision)
+    judge_decision["player2_raw_input"] = game_context["player2_move"]
+    return judge_decision
+
+
+def store_similar_decision(system_prompt, game_context, embedding, judge_decision):
+    """Remember a copy of a decision under the player input's embedding."""
+    _get_semantic_cache().add(
+        embedding, semantic_context_key(system_prompt, game_context), copy.deepcopy(judge_decision)
+    )
+
+
+def embed_player_input(client, player2_input):
+    """Embed the player's free-text input, or None if embedding fails."""
+    try:
+        result = client.models.embed_content(model=EMBEDDING_MODEL, contents=player2_input)
+    except Exception as e:
+        print("Embedding failed, skipping semantic cache:", e)
+        return None
+    return result.embeddings[0].values
+
+
+async def embed_player_input_async(client, player2_input):
+    """Async variant of embed_player_input."""
+    try:
+        result = await client.aio.models.embed_content(model=EMBEDDING_MODEL, contents=player2_input)
+    except Exception as e:
+        print("Embedding failed, skipping semantic cache:", e)
+        return None
+    return result.embeddings[0].values
+
+
+# Compact codes for the round log
+MOVE_CODES = {"rock": 0, "paper": 1, "scissors": 2, "bomb": 3, None: 4}
+WINNER_CODES = {"player1": 0, "player2": 1, "draw": 2, None: 3}
+
+
+@dataclass
+class RoundLog:
+    """
+    Session-wide log of judged rounds for post-hoc analysis.
+
+    Stored as parallel numpy arrays (one column per field) rather than a list
+    of decision dicts, so large evaluation runs stay small and statistics
+    are vectorized. Capacity doubles as rounds are appended.
+    """
+    size: int = 0
+    winners: np.ndarray = field(default_factory=lambda: np.empty(64, np.uint8))
+    p1_move: np.ndarray = field(default_factory=lambda: np.empty(64, np.uint8))
+    p2_move: np.ndarray = field(default_factory=lambda: np.empty(64, np.uint8))
+    p2_bomb_used: np.ndarray = field(default_factory=lambda: np.empty(64, np.bool_))
+
+    def append(self, judge_decision):
+        """Record the four scalars needed for analytics from a decision."""
+        if self.size == len(self.winners):
+            capacity = 2 * self.size
+            for name in ("winners", "p1_move", "p2_move", "p2_bomb_used"):
+                grown = np.empty(capacity, getattr(self, name).dtype)
+                grown[:self.size] = getattr(self, name)
+                setattr(self, name, grown)
+
+        game_logic = judge_decision.get("game_logic", {})
+        i = self.size
+        self.winners[i] = WINNER_CODES.get(game_logic.get("round_winner"), WINNER_CODES[None])
+        self.p1_move[i] = MOVE_CODES.get(game_logic.get("player1_move"), MOVE_CODES[None])
+        self.p2_move[i] = MOVE_CODES.get(game_logic.get("player2_move"), MOVE_CODES[None])
+        self.p2_bomb_used[i] = bool(judge_decision.get("state_update", {}).get("player2_bomb_used"))
+        self.size += 1
+
+    def winner_counts(self, last=None):
+        """Count rounds per winner code, optionally over only the last N rounds."""
+        winners = self.winners[:self.size]
+        if last is not None:
+            winners = winners[-last:]
+        return np.bincount(winners, minlength=len(WINNER_CODES))
+
+
+@dataclass(slots=True)
+class GameState:
+    """State of the current match (fixed fields, so slotted instead of a dict)."""
+    round_number: int = 1
+    player1_bomb_used: bool = False
+    player2_bomb_used: bool = False
+    recent: deque = field(default_factory=lambda: deque(maxlen=ROUNDS_PER_MATCH))  # Last few round results
+    tally: list = field(default_factory=lambda: [0, 0, 0])  # User wins, bot wins, draws in the current match
 
 
 def initialize_game():
     """Initialize game state."""
+    return GameState()
+
+
+def build_game_context(game_state, player2_input, player1_move=None):
+    """Build the per-round context sent to the judge."""
     return {
-        "round_number": 1,
-        "player1_bomb_used": False,
-        "player2_bomb_used": False,
-        "rounds": [],  # History of round results
+        "round_number": game_state.round_number,
+        "player1_move": player1_move,
+        "player2_move": player2_input,
+        "player1_bomb_used": game_state.player1_bomb_used,
+        "player2_bomb_used": game_state.player2_bomb_used,
     }
 
 
-def play_round(client, system_prompt, game_state, player2_input, player1_move=None):
+def build_user_message(game_context):
+    """
+    Build the message to send to Gemini for one round.
+
+    The context is serialized compactly with sorted keys: fewer tokens to
+    prefill, and a stable byte layout across rounds.
+    """
+    return f"""
+Please evaluate this round:
+
+{orjson.dumps(game_context, option=orjson.OPT_SORT_KEYS).decode()}
+
+Remember to output VALID JSON with the structure defined in your instructions.
+"""
+
+
+def judge_config(system_prompt, cache_name=None):
+    """
+    Generation config for a judge call.
+
+    Only the dynamic game context goes in `contents`; the judge instructions
+    come from the cache so the prefix stays byte-identical across rounds.
+    Temperature is pinned to 0 so identical contexts give identical decisions,
+    which is what makes the exact-match response cache valid. JSON mode makes
+    the model return bare JSON, without markdown fences to strip.
+    """
+    config = {"temperature": 0, "response_mime_type": "application/json"}
+    if cache_name:
+        config["cached_content"] = cache_name
+    else:
+        config["system_instruction"] = system_prompt
+    return config
+
+
+def parse_judge_response(response_text):
+    """Extract the judge's JSON decision (handle markdown code blocks if present)."""
+    # orjson parses the str directly; only copy it when there is a fence to strip
+    if "```" in response_text:
+        response_text = _FENCE_RE.sub("", response_text)
+    return orjson.loads(response_text)
+
+
+def apply_judge_decision(game_state, judge_decision):
+    """Update game state based on judge's decision and record the round."""
+    if judge_decision["final_result"]["move_accepted"]:
+        game_state.player1_bomb_used = judge_decision["state_update"]["player1_bomb_used"]
+        game_state.player2_bomb_used = judge_decision["state_update"]["player2_bomb_used"]
+    
+    # Store round result and update the running tally
+    game_state.recent.append(judge_decision)
+    rw = judge_decision.get("game_logic", {}).get("round_winner")
+    if rw == "player2":
+        game_state.tally[0] += 1
+    elif rw == "player1":
+        game_state.tally[1] += 1
+    else:
+        game_state.tally[2] += 1
+
+
+def canonical_move_decision(system_prompt, game_context):
+    """
+    Prefilter for inputs that are exactly a canonical move.
+
+    There is no intent to interpret, so the decision is synthesized locally
+    with the mock judge's rules and no Gemini call is made.
+    """
+    raw = game_context["player2_move"]
+    judge_decision = mock_judge_response(
+        system_prompt, {**game_context, "player2_move": raw.strip().lower()}
+    )
+    judge_decision["player2_raw_input"] = raw
+    judge_decision["intent_understanding"]["reasoning"] = "Input is exactly a canonical move."
+    final_result = judge_decision["final_result"]
+    final_result["player_message"] = final_result["player_message"].removeprefix("(MOCK) ")
+    return judge_decision
+
+
+def cached_decision(client, system_prompt, game_context):
+    """
+    Decision available without calling the judge model, or None.
+
+    Covers MOCK mode (client is None), the canonical-move prefilter and the
+    exact-match response cache.
+    """
+    if client is None:
+        return mock_judge_response(system_prompt, game_context)
+    if FAST_PATH_CANONICAL and game_context["player2_move"].strip().lower() in CANONICAL_MOVES:
+        return canonical_move_decision(system_prompt, game_context)
+    return get_cached_decision(response_cache_key(system_prompt, game_context))
+
+
+def record_judge_response(system_prompt, game_context, response_text, embedding=None):
+    """Parse a judge response and remember it in the response caches."""
+    judge_decision = parse_judge_response(response_text)
+    store_cached_decision(response_cache_key(system_prompt, game_context), judge_decision)
+    if embedding is not None:
+        store_similar_decision(system_prompt, game_context, embedding, judge_decision)
+    return judge_decision
+
+
+def fallback_decision(system_prompt, game_context, error):
+    """Judge locally with the mock judge when the Gemini call fails."""
+    print("Gemini API failed, using mock mode:", error)
+    return mock_judge_response(system_prompt, game_context)
+
+
+def play_round(client, system_prompt, game_state, player2_input, player1_move=None, cache_name=None):
     """
     Execute a single round of the game.
     
@@ -33,101 +631,218 @@ def play_round(client, system_prompt, game_state, player2_input, player1_move=No
         game_state: Current game state (round number, bomb usage)
         player2_input: The player's free-text move input
         player1_move: The AI's move (can be None if only evaluating player input)
+        cache_name: Gemini cached-content name holding the system prompt (optional)
     
     Returns:
         dict: Judge's decision with structured output
     """
-    
-    # Prepare game context for the judge
-    game_context = {
-        "round_number": game_state["round_number"],
-        "player1_move": player1_move,
-        "player2_move": player2_input,
-        "player1_bomb_used": game_state["player1_bomb_used"],
-        "player2_bomb_used": game_state["player2_bomb_used"],
-    }
-    
-    # Build the message to send to Gemini
-    user_message = f"""
-Please evaluate this round:
+    game_context = build_game_context(game_state, player2_input, player1_move)
+    judge_decision = cached_decision(client, system_prompt, game_context)
 
-{json.dumps(game_context, indent=2)}
+    embedding = None
+    if judge_decision is None and SEMANTIC_CACHE:
+        embedding = embed_player_input(client, player2_input)
+        judge_decision = get_similar_decision(system_prompt, game_context, embedding)
 
-Remember to output VALID JSON with the structure defined in your instructions.
-"""
-    # If client is None, we're in MOCK mode (local testing without Gemini API)
-    if client is None:
-        judge_decision = mock_judge_response(system_prompt, game_context)
-    else:
-        # Call Gemini API using the client (updated pattern)
+    if judge_decision is None:
         try:
-            response = client.generate_text(
-                model="gemini-1.5",
-                prompt=system_prompt + "\n" + user_message
+            # Stream so the response is being received while it is generated
+            chunks = client.models.generate_content_stream(
+                model=MODEL_NAME,
+                contents=build_user_message(game_context),
+                config=judge_config(system_prompt, cache_name),
             )
-            response_text = response.text
+            response_text = "".join(chunk.text or "" for chunk in chunks)
         except Exception as e:
-            print("Gemini API failed, using mock mode:", e)
-            judge_decision = mock_judge_response(system_prompt, game_context)
+            judge_decision = fallback_decision(system_prompt, game_context, e)
         else:
-            # Extract JSON from response (handle markdown code blocks if present)
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-
-            judge_decision = json.loads(response_text.strip())
-    
-    # Update game state based on judge's decision
-    if judge_decision["final_result"]["move_accepted"]:
-        game_state["player1_bomb_used"] = judge_decision["state_update"]["player1_bomb_used"]
-        game_state["player2_bomb_used"] = judge_decision["state_update"]["player2_bomb_used"]
-    
-    # Store round result
-    game_state["rounds"].append(judge_decision)
+            judge_decision = record_judge_response(system_prompt, game_context, response_text, embedding)
     
+    apply_judge_decision(game_state, judge_decision)
+    return judge_decision
+
+
+async def play_round_async(client, system_prompt, game_state, player2_input, player1_move=None, cache_name=None):
+    """
+    Async variant of play_round using the `client.aio` streaming API.
+
+    Takes the same arguments and returns the same decision dict, but does not
+    block the event loop while waiting on Gemini.
+    """
+    game_context = build_game_context(game_state, player2_input, player1_move)
+    judge_decision = cached_decision(client, system_prompt, game_context)
+
+    embedding = None
+    if judge_decision is None and SEMANTIC_CACHE:
+        embedding = await embed_player_input_async(client, player2_input)
+        judge_decision = get_similar_decision(system_prompt, game_context, embedding)
+
+    if judge_decision is None:
+        try:
+            chunks = await client.aio.models.generate_content_stream(
+                model=MODEL_NAME,
+                contents=build_user_message(game_context),
+                config=judge_config(system_prompt, cache_name),
+            )
+            response_text = "".join([chunk.text or "" async for chunk in chunks])
+        except Exception as e:
+            judge_decision = fallback_decision(system_prompt, game_context, e)
+        else:
+            judge_decision = record_judge_response(system_prompt, game_context, response_text, embedding)
+
+    apply_judge_decision(game_state, judge_decision)
     return judge_decision
 
 
+async def run_many(client, system_prompt, inputs, cache_name=None, max_concurrent=MAX_CONCURRENT_ROUNDS):
+    """
+    Judge many independent rounds concurrently (self-play, eval suites).
+
+    Args:
+        inputs: Iterable of (game_state, player2_input, player1_move) tuples.
+            Rounds sharing a game_state are not ordered, so give each
+            concurrent match its own state.
+        max_concurrent: Cap on in-flight Gemini requests
+
+    Returns:
+        list: Judge decisions in the same order as inputs
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def judge(game_state, player2_input, player1_move):
+        async with semaphore:
+            return await play_round_async(
+                client, system_prompt, game_state, player2_input, player1_move, cache_name
+            )
+
+    return await asyncio.gather(*(judge(*args) for args in inputs))
+
+
+def play_rounds_batch(client, system_prompt, inputs, cache_name=None, poll_interval=BATCH_POLL_SECONDS):
+    """
+    Judge many independent rounds with a single Gemini batch job (offline eval).
+
+    Rounds go through the same lookups as play_round first; the rest are
+    submitted as inline requests of one batch job, which is polled until it
+    finishes. Batch jobs
+    are queued server-side and can take minutes, so this is for regression and
+    evaluation runs, not interactive play.
+
+    Args:
+        inputs: Iterable of (game_state, player2_input, player1_move) tuples,
+            as for run_many.
+        poll_interval: Seconds between batch status checks
+
+    Returns:
+        list: Judge decisions in the same order as inputs
+    """
+    rounds = [
+        (game_state, build_game_context(game_state, player2_input, player1_move))
+        for game_state, player2_input, player1_move in inputs
+    ]
+    decisions = [None] * len(rounds)
+    pending = []  # (index, embedding) of rounds that need the API
+
+    # Same pre-call lookups as play_round: mock, fast path, exact and semantic caches
+    for i, (_, game_context) in enumerate(rounds):
+        decisions[i] = cached_decision(client, system_prompt, game_context)
+        embedding = None
+        if decisions[i] is None and SEMANTIC_CACHE:
+            embedding = embed_player_input(client, game_context["player2_move"])
+            decisions[i] = get_similar_decision(system_prompt, game_context, embedding)
+        if decisions[i] is None:
+            pending.append((i, embedding))
+
+    if pending:
+        config = judge_config(system_prompt, cache_name)
+        responses = []
+        try:
+            job = client.batches.create(
+                model=MODEL_NAME,
+                src=[
+                    {"contents": build_user_message(rounds[i][1]), "config": config}
+                    for i, _ in pending
+                ],
+            )
+            while job.state.name not in BATCH_DONE_STATES:
+                time.sleep(poll_interval)
+                job = client.batches.get(name=job.name)
+            if job.dest and job.dest.inlined_responses:
+                responses = job.dest.inlined_responses
+            else:
+                print("Gemini batch job ended without results:", job.state.name, job.error)
+        except Exception as e:
+            print("Gemini batch API failed, using mock mode:", e)
+
+        # Each entry falls back to the mock judge on its own, so one bad
+        # response never discards the rest of the batch
+        for n, (i, embedding) in enumerate(pending):
+            game_context = rounds[i][1]
+            result = responses[n] if n < len(responses) else None
+            if result is None:
+                decisions[i] = mock_judge_response(system_prompt, game_context)
+                continue
+            try:
+                if result.error or result.response is None:
+                    raise RuntimeError(result.error or "empty batch response")
+                decisions[i] = record_judge_response(
+                    system_prompt, game_context, result.response.text, embedding
+                )
+            except Exception as e:
+                decisions[i] = fallback_decision(system_prompt, game_context, e)
+
+    for (game_state, _), judge_decision in zip(rounds, decisions):
+        apply_judge_decision(game_state, judge_decision)
+    return decisions
+
+
+_ROUND_HEADER = """
+{rule}
+ROUND {d[round_number]}
+{rule}
+
+[INTENT UNDERSTANDING]
+  Raw Input: {d[player2_raw_input]}
+  Move Understood: {d[intent_understanding][move_understood]}
+  Reasoning: {d[intent_understanding][reasoning]}
+
+[VALIDATION]
+  Status: {d[validation][status]}
+  Reason: {d[validation][reason]}
+"""
+
+_ROUND_GAME_LOGIC = """
+[GAME LOGIC]
+  Player 1 Move: {d[game_logic][player1_move]}
+  Player 2 Move: {d[game_logic][player2_move]}
+  Round Winner: {d[game_logic][round_winner]}
+  Explanation: {d[game_logic][round_explanation]}
+"""
+
+_ROUND_FOOTER = """
+[STATE UPDATE]
+  Player 1 Bomb Used: {d[state_update][player1_bomb_used]}
+  Player 2 Bomb Used: {d[state_update][player2_bomb_used]}
+  Bombs Remaining: P1={d[state_update][bombs_remaining][player1]}, P2={d[state_update][bombs_remaining][player2]}
+
+[RESULT]
+  Move Accepted: {d[final_result][move_accepted]}
+  Action: {d[final_result][action]}
+  Message: {d[final_result][player_message]}
+"""
+
+# Game logic is only shown for VALID rounds
+_ROUND_TEMPLATE_VALID = _ROUND_HEADER + _ROUND_GAME_LOGIC + _ROUND_FOOTER
+_ROUND_TEMPLATE_OTHER = _ROUND_HEADER + _ROUND_FOOTER
+
+
 def print_round_result(judge_decision):
-    """Pretty-print the judge's decision for this round."""
-    print("\n" + "="*70)
-    print(f"ROUND {judge_decision['round_number']}")
-    print("="*70)
-    
-    # Intent Understanding
-    print("\n[INTENT UNDERSTANDING]")
-    print(f"  Raw Input: {judge_decision['player2_raw_input']}")
-    print(f"  Move Understood: {judge_decision['intent_understanding']['move_understood']}")
-    print(f"  Reasoning: {judge_decision['intent_understanding']['reasoning']}")
-    
-    # Validation
-    print(f"\n[VALIDATION]")
-    print(f"  Status: {judge_decision['validation']['status']}")
-    print(f"  Reason: {judge_decision['validation']['reason']}")
-    
-    # Game Logic
+    """Pretty-print the judge's decision for this round (one write to stdout)."""
     if judge_decision['validation']['status'] == 'VALID':
-        print(f"\n[GAME LOGIC]")
-        print(f"  Player 1 Move: {judge_decision['game_logic']['player1_move']}")
-        print(f"  Player 2 Move: {judge_decision['game_logic']['player2_move']}")
-        print(f"  Round Winner: {judge_decision['game_logic']['round_winner']}")
-        print(f"  Explanation: {judge_decision['game_logic']['round_explanation']}")
-    
-    # State Update
-    print(f"\n[STATE UPDATE]")
-    print(f"  Player 1 Bomb Used: {judge_decision['state_update']['player1_bomb_used']}")
-    print(f"  Player 2 Bomb Used: {judge_decision['state_update']['player2_bomb_used']}")
-    print(f"  Bombs Remaining: P1={judge_decision['state_update']['bombs_remaining']['player1']}, "
-          f"P2={judge_decision['state_update']['bombs_remaining']['player2']}")
-    
-    # Final Result
-    print(f"\n[RESULT]")
-    print(f"  Move Accepted: {judge_decision['final_result']['move_accepted']}")
-    print(f"  Action: {judge_decision['final_result']['action']}")
-    print(f"  Message: {judge_decision['final_result']['player_message']}")
+        template = _ROUND_TEMPLATE_VALID
+    else:
+        template = _ROUND_TEMPLATE_OTHER
+    sys.stdout.write(template.format(d=judge_decision, rule="=" * 70))
 
 
 def mock_judge_response(system_prompt, game_context):
@@ -137,28 +852,25 @@ def mock_judge_response(system_prompt, game_context):
     It returns the same strict JSON schema that the real prompt expects.
     """
     raw = game_context.get("player2_move") or ""
-    raw_l = raw.lower()
 
-    # Intent heuristics (simple keyword matching)
-    move_map = {
-        "rock": ["rock", "rok", "stone", "boulder", "fist"],
-        "paper": ["paper", "ppr", "pap", "sheet", "document"],
-        "scissors": ["scissors", "scissor", "sciz", "snip", "shears"],
-        "bomb": ["bomb", "boom", "nuke", "dynamite", "c4", "explosion"]
-    }
+    raw_l = raw.lower()
 
+    # Intent heuristics: the earliest keyword in the input picks the move.
+    # A whole-word keyword is resolved by dict lookup, so the regex only has
+    # to scan the text before it for an earlier partial match (e.g. "rocks").
     move_understood = None
-    for mv, keys in move_map.items():
-        for k in keys:
-            if k in raw_l:
-                move_understood = mv
-                break
-        if move_understood:
+    end = len(raw_l)
+    for w in _WORD_RE.finditer(raw_l):
+        if w.group() in _MOVE_TOKENS:
+            move_understood = _MOVE_TOKENS[w.group()]
+            end = w.start()
             break
+    m = _MOVE_RE.search(raw_l, 0, end)
+    if m:
+        move_understood = m.lastgroup
 
     # Refusals
-    refuses = ["pass", "skip", "i don't want", "dont want", "not play", "nope"]
-    if any(r in raw_l for r in refuses):
+    if _REFUSE_RE.search(raw_l):
         move_understood = None
 
     # Validation
@@ -179,31 +891,8 @@ def mock_judge_response(system_prompt, game_context):
     round_explanation = "No winner determined."
 
     if validation_status == "VALID":
-        # Handle bombs
-        if p1 == p2:
-            round_winner = "draw"
-            round_explanation = f"Both players played {p1}. It's a draw."
-        elif p1 == "bomb" and p2 == "bomb":
-            round_winner = "draw"
-            round_explanation = "Both players used bomb. Draw."
-        elif p1 == "bomb":
-            round_winner = "player1"
-            round_explanation = "Player1's bomb beats player2's move."
-        elif p2 == "bomb":
-            round_winner = "player2"
-            round_explanation = "Player2's bomb beats player1's move."
-        else:
-            # Standard RPS
-            beats = {"rock": "scissors", "scissors": "paper", "paper": "rock"}
-            if beats.get(p1) == p2:
-                round_winner = "player1"
-                round_explanation = f"{p1} beats {p2}."
-            elif beats.get(p2) == p1:
-                round_winner = "player2"
-                round_explanation = f"{p2} beats {p1}."
-            else:
-                round_winner = "draw"
-                round_explanation = "No clear winner (unexpected input)."
+        # An unrecognized player1 move resolves the same as a missing one
+        round_winner, round_explanation = _OUTCOME.get((p1, p2)) or _OUTCOME[(None, p2)]
 
     # State updates
     p1_bomb = bool(game_context.get("player1_bomb_used"))
@@ -246,12 +935,12 @@ def mock_judge_response(system_prompt, game_context):
     return response
 
 
-def main():
-    """Main game loop."""
+def main(seed=None):
+    """Main game loop. Pass a seed to make the AI's moves reproducible."""
     
     # Initialize Gemini API (or fall back to MOCK mode for local testing)
-    api_key = "PASTE_YOUR_GEMINI_API_KEY_HERE"  # Replace with your actual API key or set via environment variable
-    mock_mode = os.getenv("MOCK_GEMINI", "0") == "1"
+    api_key = GEMINI_API_KEY
+    mock_mode = MOCK_MODE
 
     if not api_key and not mock_mode:
         print("WARNING: GEMINI_API_KEY not set. Starting in MOCK mode for local testing.")
@@ -260,15 +949,22 @@ def main():
     if mock_mode:
         client = None
     else:
-        # Initialize Gemini client with API key
-        client = genai.Client(api_key=api_key)
+        # Initialize Gemini client with API key (reused across matches)
+        client = create_client(api_key)
 
     
     # Load system prompt
     system_prompt = load_system_prompt()
+
+    # Cache the static judge instructions server-side for the session
+    prompt_cache = create_prompt_cache(client, system_prompt) if client else None
+    if prompt_cache is not None:
+        atexit.register(delete_prompt_cache, client, prompt_cache)
     
     # Initialize game state
     game_state = initialize_game()
+    round_log = RoundLog()
+    rng = random.Random(seed)
     
     print("\n" + "="*70)
     print("ROCK-PAPER-SCISSORS PLUS: AI JUDGE")
@@ -279,12 +975,17 @@ def main():
     
     # Game loop
     while True:
-        print(f"\n--- Round {game_state['round_number']} ---")
+        print(f"\n--- Round {game_state.round_number} ---")
         
         # Get player input
         player_input = input("Your move: ").strip()
         
         if player_input.lower() in ["quit", "exit", "q"]:
+            if round_log.size:
+                # Rounds without a winner count as draws, as in the match tally
+                bot_wins, user_wins, draws, no_winner = round_log.winner_counts()
+                print(f"\nSession: {round_log.size} rounds, User wins: {user_wins}, "
+                      f"Bot wins: {bot_wins}, Draws: {draws + no_winner}")
             print("\nThanks for playing!")
             break
         
@@ -294,7 +995,7 @@ def main():
         
        
         # The judge will evaluate both moves
-        ai_move =random.choice(["rock","paper","scissors","bomb"])
+        ai_move = AI_MOVES[rng.getrandbits(2)]
 
         
         # Play the round
@@ -303,29 +1004,21 @@ def main():
             system_prompt,
             game_state,
             player_input,
-            ai_move
+            ai_move,
+            prompt_cache_name(client, system_prompt, prompt_cache)
         )
         
+        round_log.append(judge_decision)
+
         # Display result
         print_round_result(judge_decision)
         
         # Move to next round
-        game_state["round_number"] += 1
+        game_state.round_number += 1
 
         # After every 3 rounds evaluate overall winner and reset game for another match
-        if len(game_state["rounds"]) % 3 == 0:
-            last_three = game_state["rounds"][-3:]
-            user_wins = 0
-            bot_wins = 0
-            draws = 0
-            for rd in last_three:
-                rw = rd.get("game_logic", {}).get("round_winner")
-                if rw == "player2":
-                    user_wins += 1
-                elif rw == "player1":
-                    bot_wins += 1
-                else:
-                    draws += 1
+        if len(game_state.recent) == ROUNDS_PER_MATCH:
+            user_wins, bot_wins, draws = game_state.tally
 
             if user_wins > bot_wins:
                 final = "User wins"
@@ -345,5 +1038,7 @@ def main():
           
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Rock-Paper-Scissors Plus with an AI judge")
+    parser.add_argument("--seed", type=int, help="seed the AI's move choice for reproducible runs")
+    main(parser.parse_args().seed)
 